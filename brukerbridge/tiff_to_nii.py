@@ -28,6 +28,9 @@ def tiff_to_nii(xml_file):
     root = tree.getroot()
     # Get all volumes
     sequences = root.findall('Sequence')
+    # Find each sequence's frames once; a findall per timepoint is quadratic in the
+    # length of plane series, which can run to tens of thousands of frames
+    sequence_frames = [sequence.findall('Frame') for sequence in sequences]
 
      # Check if bidirectional - will affect loading order
     isBidirectionalZ = sequences[0].get('bidirectionalZ')
@@ -39,22 +42,22 @@ def tiff_to_nii(xml_file):
 
     # Get axis dims
     if root.find('Sequence').get('type') == 'TSeries Timed Element': # Plane time series
-        num_timepoints = len(sequences[0].findall('Frame'))
+        num_timepoints = len(sequence_frames[0])
         num_z = 1
         isVolumeSeries = False
     elif root.find('Sequence').get('type') == 'TSeries ZSeries Element': # Volume time series
         num_timepoints = len(sequences)
-        num_z = len(sequences[0].findall('Frame'))
+        num_z = len(sequence_frames[0])
         isVolumeSeries = True
     else: # Default to: Volume time series
         num_timepoints = len(sequences)
-        num_z = len(sequences[0].findall('Frame'))
+        num_z = len(sequence_frames[0])
         isVolumeSeries = True
 
     print('isVolumeSeries is {}'.format(isVolumeSeries))
 
     num_channels = get_num_channels(sequences[0])
-    test_file = sequences[0].findall('Frame')[0].findall('File')[0].get('filename')
+    test_file = sequence_frames[0][0].findall('File')[0].get('filename')
     fullfile = os.path.join(data_dir, test_file)
 
     ### Luke added try except 20221024 because sometimes but rarely a file doesn't exist
@@ -72,15 +75,30 @@ def tiff_to_nii(xml_file):
     print('num_y: {}'.format(num_y))
     print('num_x: {}'.format(num_x))
 
+    # Aborted scans are known from the xml alone, so check now in order to size the
+    # nii before any tiffs are read
+    if isVolumeSeries:
+        for i in range(1, num_timepoints):
+            if len(sequence_frames[i]) != len(sequence_frames[i-1]):
+                aborted = True
+                break
+
     # loop over channels
     for channel in range(num_channels):
         last_num_z = None
-        image_array = np.zeros((num_timepoints, num_z, num_y, num_x), dtype=np.uint16)
+        save_name = xml_file[:-4] + '_channel_{}'.format(channel+1) + '.nii'
+        # written under a temporary name so a crash doesn't leave a partial .nii that
+        # would be skipped on rerun and uploaded to oak
+        temp_save_name = save_name + '.tmp'
+        image_array, nii_data = create_nii_memmap(temp_save_name,
+                                                  (num_timepoints, num_z, num_y, num_x),
+                                                  isVolumeSeries,
+                                                  aborted)
         print('Created empty array of shape {}'.format(image_array.shape))
         if isMultiPageTiff and (isVolumeSeries is False):
              # saved as a single big tif for all time steps
             print('isMultiPageTiff is {} / isVolumeSeries is {}'.format(isMultiPageTiff, isVolumeSeries))
-            frames = [sequences[0].findall('Frame')[0]]
+            frames = [sequence_frames[0][0]]
             files = frames[0].findall('File')
             filename = files[channel].get('filename')
             fullfile = os.path.join(data_dir, filename)
@@ -96,7 +114,7 @@ def tiff_to_nii(xml_file):
                 #    print('{}/{}'.format(i+1, num_timepoints))
 
                 if isVolumeSeries: # For a given volume, get all frames
-                    frames = sequences[i].findall('Frame')
+                    frames = sequence_frames[i]
                     current_num_z = len(frames)
                     # Handle aborted scans for volumes
                     if last_num_z is not None:
@@ -112,7 +130,7 @@ def tiff_to_nii(xml_file):
                         frames = frames[::-1]
 
                 else: # Plane series: Get frame
-                    frames = [sequences[0].findall('Frame')[i]]
+                    frames = [sequence_frames[0][i]]
 
                 if isMultiPageTiff:
                     files = frames[0].findall('File')
@@ -144,60 +162,101 @@ def tiff_to_nii(xml_file):
                                             total_mem=32,
                                             mode='tiff_convert')
 
-        if isVolumeSeries:
-            # Will start as t,z,x,y. Want y,x,z,t
-            image_array = np.moveaxis(image_array,1,-1) # Now t,x,y,z
-            image_array = np.moveaxis(image_array,0,-1) # Now x,y,z,t
-            image_array = np.swapaxes(image_array,0,1) # Now y,x,z,t
-
-            # Toss last volume if aborted
-            if aborted:
-                image_array = image_array[:,:,:,:-1]
-        else:
-            image_array = np.squeeze(image_array) # t, x, y
-            image_array = np.moveaxis(image_array, 0, -1) # x, y, t
-            image_array = np.swapaxes(image_array, 0, 1) # y, x, t
-
-        print('Final array shape = {}'.format(image_array.shape))
+        print('Final array shape = {}'.format(nii_data.shape))
 
-        aff = np.eye(4)
-        save_name = xml_file[:-4] + '_channel_{}'.format(channel+1) + '.nii'
-        if isVolumeSeries:
-            img = nib.Nifti1Image(image_array, aff) # 32 bit: maxes out at 32767 in any one dimension
-        else:
-            img = nib.Nifti2Image(image_array, aff) # 64 bit
-        image_array = None # for memory
         print('Saving nii as {}'.format(save_name))
-        img.to_filename(save_name)
-        img = None # for memory
+        nii_data.flush()
+        # drop both views to unmap the file, otherwise windows won't let it be renamed
+        image_array = None
+        nii_data = None
+        os.replace(temp_save_name, save_name)
         print('Saved! sleeping for 2 sec to help memory reconfigure...',end='')
         time.sleep(2)
         print('Sleep over')
         print('\n\n')
 
+def to_nii_axes(image_array, isVolumeSeries, aborted):
+    """Reorders a t,z,y,x image array into the axes it is saved to nii with"""
+    if isVolumeSeries:
+        # Will start as t,z,x,y. Want y,x,z,t
+        image_array = np.moveaxis(image_array,1,-1) # Now t,x,y,z
+        image_array = np.moveaxis(image_array,0,-1) # Now x,y,z,t
+        image_array = np.swapaxes(image_array,0,1) # Now y,x,z,t
+
+        # Toss last volume if aborted
+        if aborted:
+            image_array = image_array[:,:,:,:-1]
+    else:
+        image_array = np.squeeze(image_array) # t, x, y
+        image_array = np.moveaxis(image_array, 0, -1) # x, y, t
+        image_array = np.swapaxes(image_array, 0, 1) # y, x, t
+    return image_array
+
+def create_nii_memmap(save_name, shape, isVolumeSeries, aborted):
+    """Writes the nii header for a t,z,y,x image of the given shape to save_name and
+    maps the file's data block into memory, so frames go straight to disk instead of
+    the whole image having to fit in RAM before it is saved.
+
+    Returns a t,z,y,x array to fill frame by frame, and the same data in the axis
+    order of the nii file."""
+    # Tag each axis with a distinct stride to see where to_nii_axes moves it
+    probe = np.lib.stride_tricks.as_strided(np.zeros(1, dtype=np.uint8), shape=shape, strides=(1, 2, 4, 8))
+    probe = to_nii_axes(probe, isVolumeSeries, aborted)
+
+    aff = np.eye(4)
+    placeholder = np.broadcast_to(np.uint16(0), probe.shape) # header only needs shape and dtype
+    if isVolumeSeries:
+        img = nib.Nifti1Image(placeholder, aff) # 32 bit: maxes out at 32767 in any one dimension
+    else:
+        img = nib.Nifti2Image(placeholder, aff) # 64 bit
+    img.update_header()
+    img.header.set_slope_inter(1, 0) # what to_filename writes for unscaled data
+    with open(save_name, 'wb') as f:
+        img.header.write_to(f)
+        offset = img.header.get_data_offset() # only set once written
+        f.truncate(offset + placeholder.size * placeholder.itemsize)
+
+    data = np.memmap(save_name, dtype=np.uint16, mode='r+', offset=offset, shape=placeholder.size)
+    nii_data = data.reshape(probe.shape, order='F') # nii is stored fortran order
+
+    # View the same bytes as t,z,y,x; axes squeezed out above have length 1
+    image_shape = []
+    image_strides = []
+    for axis in range(len(shape)):
+        nii_axes = [i for i, stride in enumerate(probe.strides) if stride == 2**axis]
+        if nii_axes:
+            image_shape.append(nii_data.shape[nii_axes[0]])
+            image_strides.append(nii_data.strides[nii_axes[0]])
+        else:
+            image_shape.append(1)
+            image_strides.append(0)
+    image_array = np.ndarray(image_shape, dtype=np.uint16, buffer=data, strides=image_strides)
+    return image_array, nii_data
+
 def get_num_channels(sequence):
-    frame = sequence.findall('Frame')[0]
+    frame = sequence.find('Frame') # first frame only, no need to collect them all
     files = frame.findall('File')
     return len(files)
 
 def convert_tiff_collections_to_nii(directory):
-    for item in os.listdir(directory):
-        new_path = directory + '/' + item
+    # scandir already knows which entries are directories, so no stat per entry
+    with os.scandir(directory) as it:
+        entries = list(it)
+    for entry in entries:
+        new_path = directory + '/' + entry.name
 
         # Check if item is a directory
-        if os.path.isdir(new_path):
+        if entry.is_dir():
             print(1) #debug
             convert_tiff_collections_to_nii(new_path)
 
         # If the item is a file
         else:
             # If the item is an xml file
-            if '.xml' in item:
+            if entry.name.endswith('.xml'):
                 print(3) #debug
-                tree = ET.parse(new_path)
-                root = tree.getroot()
                 # If the item is an xml file with scan info
-                if root.tag == 'PVScan':
+                if bridge.is_pvscan_xml(new_path):
 
                     # Also, verify that this folder doesn't already contain any .niis
                     # This is useful if rebooting the pipeline due to some error, and
@@ -8,6 +8,7 @@ from tqdm import tqdm
 import psutil
 from PIL import Image
 import time
+import brukerbridge as bridge
 
 def tiff_to_nii(xml_file):
     aborted = False
@@ -18,6 +19,9 @@ def tiff_to_nii(xml_file):
     root = tree.getroot()
     # Get all volumes
     sequences = root.findall('Sequence')
+    # Find each sequence's frames once; a findall per timepoint is quadratic in the
+    # length of plane series, which can run to tens of thousands of frames
+    sequence_frames = [sequence.findall('Frame') for sequence in sequences]
 
      # Check if bidirectional - will affect loading order
     isBidirectionalZ = sequences[0].get('bidirectionalZ')
@@ -29,22 +33,22 @@ def tiff_to_nii(xml_file):
 
     # Get axis dims
     if root.find('Sequence').get('type') == 'TSeries Timed Element': # Plane time series
-        num_timepoints = len(sequences[0].findall('Frame'))
+        num_timepoints = len(sequence_frames[0])
         num_z = 1
         isVolumeSeries = False
     elif root.find('Sequence').get('type') == 'TSeries ZSeries Element': # Volume time series
         num_timepoints = len(sequences)
-        num_z = len(sequences[0].findall('Frame'))
+        num_z = len(sequence_frames[0])
         isVolumeSeries = True
     else: # Default to: Volume time series
         num_timepoints = len(sequences)
-        num_z = len(sequences[0].findall('Frame'))
+        num_z = len(sequence_frames[0])
         isVolumeSeries = True
 
     print('isVolumeSeries is {}'.format(isVolumeSeries))
 
     num_channels = get_num_channels(sequences[0])
-    test_file = sequences[0].findall('Frame')[0].findall('File')[0].get('filename')
+    test_file = sequence_frames[0][0].findall('File')[0].get('filename')
     fullfile = os.path.join(data_dir, test_file)
     img = imread(fullfile)
     num_y = np.shape(img)[0]
@@ -78,18 +82,18 @@ def tiff_to_nii(xml_file):
     #run through each set of timepoints to make the different nii files
     print('timepoint ranges: ', timepoint_ranges)
     for i in range(len(timepoint_ranges)):
-        create_nii_file(timepoint_ranges[i], num_channels, num_timepoints, num_z, num_y, num_x, isVolumeSeries, isBidirectionalZ, sequences, xml_file, data_dir, aborted)
+        create_nii_file(timepoint_ranges[i], num_channels, num_timepoints, num_z, num_y, num_x, isVolumeSeries, isBidirectionalZ, sequence_frames, xml_file, data_dir, aborted)
      
         
         
 
 def get_num_channels(sequence):
-    frame = sequence.findall('Frame')[0]
+    frame = sequence.find('Frame') # first frame only, no need to collect them all
     files = frame.findall('File')
     return len(files)
 
 
-def create_nii_file(timepoint_range, num_channels, num_timepoints, num_z, num_y, num_x, isVolumeSeries, isBidirectionalZ, sequences, xml_file, data_dir, aborted):
+def create_nii_file(timepoint_range, num_channels, num_timepoints, num_z, num_y, num_x, isVolumeSeries, isBidirectionalZ, sequence_frames, xml_file, data_dir, aborted):
     """this creates a nii file in the same way as before, but it creates seperate nii files if the original data is bigger than the size memory allows.
     The save name appends on the starting frame number to keep the files seperate
     timepoint_range is a tuple that contains (timepoint_start, timepoint_end) for each set"""
@@ -108,7 +112,7 @@ def create_nii_file(timepoint_range, num_channels, num_timepoints, num_z, num_y,
                 print('{}/{}'.format(i+1, timepoint_end-timepoint_start))
             
             if isVolumeSeries: # For a given volume, get all frames
-                frames = sequences[i].findall('Frame')
+                frames = sequence_frames[i]
                 current_num_z = len(frames)
                 # Handle aborted scans for volumes
                 if last_num_z is not None:
@@ -124,7 +128,7 @@ def create_nii_file(timepoint_range, num_channels, num_timepoints, num_z, num_y,
                     frames = frames[::-1]
 
             else: # Plane series: Get frame
-                frames = [sequences[0].findall('Frame')[i]]
+                frames = [sequence_frames[0][i]]
 
             # loop over depth (z-dim)
             for j, frame in enumerate(frames):
@@ -180,21 +184,22 @@ def create_nii_file(timepoint_range, num_channels, num_timepoints, num_z, num_y,
 
 
 def convert_tiff_collections_to_nii_split(directory): 
-    for item in os.listdir(directory):
-        new_path = directory + '/' + item
+    # scandir already knows which entries are directories, so no stat per entry
+    with os.scandir(directory) as it:
+        entries = list(it)
+    for entry in entries:
+        new_path = directory + '/' + entry.name
 
         # Check if item is a directory
-        if os.path.isdir(new_path):
+        if entry.is_dir():
             convert_tiff_collections_to_nii_split(new_path)
             
         # If the item is a file
         else:
             # If the item is an xml file
-            if '.xml' in item:
-                tree = ET.parse(new_path)
-                root = tree.getroot()
+            if entry.name.endswith('.xml'):
                 # If the item is an xml file with scan info
-                if root.tag == 'PVScan':
+                if bridge.is_pvscan_xml(new_path):
 
                     # Also, verify that this folder doesn't already contain any .niis
                     # This is useful if rebooting the pipeline due to some error, and
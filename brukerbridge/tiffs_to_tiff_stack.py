@@ -1,26 +1,27 @@
-from xml.etree import ElementTree as ET
 import os
 import sys
-import glob
+from fnmatch import fnmatch
 #from skimage.external import tifffile # this is deprecated in new skimage. directly import tifffile.
 import tifffile
+import brukerbridge as bridge
 
 def convert_tiff_collections_to_stack(directory):
-    for item in os.listdir(directory):
-        new_path = os.path.join(directory, item)
+    # scandir already knows which entries are directories, so no stat per entry
+    with os.scandir(directory) as it:
+        entries = list(it)
+    for entry in entries:
+        new_path = os.path.join(directory, entry.name)
 
         # Check if item is a directory
-        if os.path.isdir(new_path):
+        if entry.is_dir():
             convert_tiff_collections_to_stack(new_path)
 
         # If the item is a file
         else:
             # If the item is an xml file
-            if '.xml' in item:
-                tree = ET.parse(new_path)
-                root = tree.getroot()
+            if entry.name.endswith('.xml'):
                 # If the item is an xml file with scan info
-                if root.tag == 'PVScan':
+                if bridge.is_pvscan_xml(new_path):
                     tiffs_to_stack(directory)
 
 def tiffs_to_stack(directory):
@@ -31,4 +32,11 @@ def tiffs_to_stack(directory):
         #   only the first tif file using stack.save is sufficient...
         # for filename in sorted(glob.glob(os.path.join(directory, '*.tif'))):
         #     stack.save(tifffile.imread(filename))
-        stack.save(tifffile.imread(sorted(glob.glob(os.path.join(directory, '*.tif')))[0]))
+        stack.save(tifffile.imread(first_tif(directory)))
+
+def first_tif(directory):
+    # Same match as glob(directory/*.tif), but only the smallest name is kept rather
+    # than sorting every tif in the acquisition to take the first
+    with os.scandir(directory) as it:
+        return min(entry.path for entry in it
+                   if fnmatch(entry.name, '*.tif') and not entry.name.startswith('.'))
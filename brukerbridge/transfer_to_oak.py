@@ -1,9 +1,13 @@
 import os
 import sys
 import time
-from shutil import copyfile
+from shutil import copyfile, copyfileobj
 from datetime import datetime
 
+# python 3.7's copyfile goes through 16KB reads, which is slow for multi GB niis.
+# 3.8+ already copies with a 1MB buffer on windows and in the kernel elsewhere
+COPY_BUFSIZE = 1024*1024
+
 def transfer_to_oak(source, target, allowable_extensions, verbose): 
     print(source)
     for item in os.listdir(source):
@@ -52,12 +56,19 @@ def transfer_to_oak(source, target, allowable_extensions, verbose):
                 print('{} | Transfering file {}; size = {:.2f} GB'.format(current_time, target_path, file_size_GB),end='')
 
                 t0 = time.time()
-                copyfile(source_path, target_path)
+                copy_file(source_path, target_path)
                 duration = time.time()-t0
                 duration += 0.1
 
                 print('done. duration: {} sec; {} MB/SEC'.format(int(duration), int(file_size_MB/duration)))
 
+def copy_file(source_path, target_path):
+    if sys.version_info >= (3, 8):
+        copyfile(source_path, target_path)
+    else:
+        with open(source_path, 'rb') as fsrc, open(target_path, 'wb') as fdst:
+            copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+
 def start_oak_transfer(directory_from, oak_target, allowable_extensions, add_to_build_que, verbose=True):
     directory_to = os.path.join(oak_target, os.path.split(directory_from)[-1])
     try:
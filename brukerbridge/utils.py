@@ -95,11 +95,22 @@ def get_dir_size(directory):
     return total_size*10**-9 #report in GB
 
 def get_checksum(filename):
+    # hash in chunks, transferred niis can be larger than the memory of the machine
+    md5 = hashlib.md5()
     with open(filename, "rb") as f:
-        bytes = f.read()  # read file as bytes
-        readable_hash = hashlib.md5(bytes).hexdigest()
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            md5.update(chunk)
+    readable_hash = md5.hexdigest()
     return readable_hash
 
+def is_pvscan_xml(xml_file):
+    # only the root tag is needed, so stop at the first element instead of building
+    # the whole tree, which for long series runs to hundreds of MB
+    with open(xml_file, "rb") as f:
+        for _, elem in ET.iterparse(f, events=("start",)):
+            return elem.tag == "PVScan"
+    return False
+
 def get_json_data(file_path):
     with open(file_path) as f:  
         data = json.load(f)
@@ -1,94 +1,353 @@
 import json
 import os
+import queue
+import signal
+import sqlite3
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from multiprocessing.connection import Client
 from time import strftime
 
 log_folder = "C:/Users/User/Desktop/dataflow_logs"
+# a user directory modified this recently (ns) is listed again on the next look, see
+# update_queue_state
+racy_mtime_window = 2 * 10**9
 root_directory = "D:/"
+worker_script = "C:/Users/User/projects/brukerbridge/scripts/worker.py"
+worker_address = ("localhost", 6001)
+worker_authkey = b"brukerbridge"
+# number of folders processed at once, each by its own worker on consecutive ports
+# keep at 1 unless you know otherwise: ripper_killer.bat kills every running ripper
+# and tiff_to_nii assumes it has the machine's memory to itself
+max_concurrent_jobs = 1
+# folders are picked up by these suffixes, highest priority first
+queue_suffixes = ["__priority__", "__queue__", "__lowqueue__"]
+# set by ctrl-c, the main loop then requeues jobs in progress and shuts down
+stop_event = threading.Event()
 
 
 def main():
 
     # banned_dirs = get_banned_dirs()
-    while True:
-        queued_folder, stripped_folder = get_queued_folder()
-        if queued_folder is not None:
-            launch_main_processing(queued_folder, stripped_folder, log_folder)
-        time.sleep(0.1)
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+    state = open_state_db()
+    workers = []
+    try:
+        run_queue(state, workers)
+    finally:
+        # otherwise worker.py outlives the watcher, still holding its port
+        for worker in workers:
+            worker.close()
+        state.close()
 
 
-def get_queued_folder():
-    candidate_dir_fullpaths = []
+def run_queue(state, workers):
+    idle_workers = queue.Queue()
+    host, port = worker_address
+    for i in range(max_concurrent_jobs):
+        workers.append(Worker((host, port + i)))
+        idle_workers.put(workers[-1])
 
-    for user_dir in os.listdir(root_directory):
-        user_dir_fullpath = os.path.join(root_directory, user_dir)
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=max_concurrent_jobs) as executor:
+        try:
+            while not stop_event.is_set():
+                if len(in_flight) < max_concurrent_jobs:
+                    queued_folder, stripped_folder = get_queued_folder(
+                        state, exclude=in_flight
+                    )
+                    if queued_folder is not None:
+                        worker = idle_workers.get()
+                        future = executor.submit(
+                            run_job,
+                            queued_folder,
+                            stripped_folder,
+                            worker,
+                            idle_workers,
+                        )
+                        in_flight[queued_folder] = (future, worker)
+                        continue
 
-        if user_dir != "System Volume Information" and os.path.isdir(user_dir_fullpath):
-            candidate_dir_fullpaths += [
-                os.path.join(user_dir_fullpath, imaging_dir)
-                for imaging_dir in os.listdir(user_dir_fullpath)
-            ]
+                if not in_flight:
+                    stop_event.wait(0.1)
+                    continue
 
-    high_priority_dir_fullpaths = [
-        x for x in candidate_dir_fullpaths if x.endswith("__priority__")
-    ]
-    regular_dir_fullpaths = [
-        x for x in candidate_dir_fullpaths if x.endswith("__queue__")
-    ]
-    low_priority_dir_fullpaths = [
-        x for x in candidate_dir_fullpaths if x.endswith("__lowqueue__")
+                # wakes as soon as a job finishes rather than waiting out the poll
+                done, _ = wait(
+                    [future for future, _ in in_flight.values()],
+                    timeout=0.1,
+                    return_when=FIRST_COMPLETED,
+                )
+                for folder in [
+                    f for f, (future, _) in in_flight.items() if future in done
+                ]:
+                    future, _ = in_flight.pop(folder)
+                    if future.exception() is not None:
+                        print(f"Job {folder} raised {future.exception()!r}")
+        finally:
+            # also on an error in the loop, so the executor isn't left waiting on
+            # jobs that can run for hours. setting stop_event keeps the preempted
+            # workers from being restarted
+            stop_event.set()
+            print("Stopping, jobs in progress will be left in the queue")
+            for folder, (_, worker) in in_flight.items():
+                worker.preempt(folder)
+
+
+def get_priority_rank(folder):
+    for rank, suffix in enumerate(queue_suffixes):
+        if folder.endswith(suffix):
+            return rank
+    return len(queue_suffixes)
+
+
+def run_job(dir_to_process, stripped_folder, worker, idle_workers):
+    try:
+        launch_main_processing(dir_to_process, stripped_folder, log_folder, worker)
+    finally:
+        if not worker.broken:
+            idle_workers.put(worker)
+
+
+class Worker:
+    """Long-lived worker.py process that runs main.py on the jobs it is sent, so
+    that interpreter startup and imports are only paid once rather than per job."""
+
+    def __init__(self, address):
+        self.address = address
+        self.proc = None
+        self.conn = None
+        # guards current_job and preempted_job between the main thread and the job
+        # thread
+        self.lock = threading.Lock()
+        # the folder the worker process is running right now
+        self.current_job = None
+        # set from the main thread to the folder whose job should be killed
+        self.preempted_job = None
+        # set once the worker couldn't be restarted, it must not be sent more jobs
+        self.broken = False
+        self.start()
+
+    def start(self):
+        host, port = self.address
+        # give the worker real files for fd 1 and 2, which jobs redirect to their log,
+        # instead of the console
+        worker_log = os.path.join(log_folder, f"worker_{port}.txt")
+        with open(worker_log, "a") as f:
+            self.proc = subprocess.Popen(
+                [sys.executable, worker_script, host, str(port)],
+                stdout=f,
+                stderr=subprocess.STDOUT,
+            )
+        # the listener takes a moment to come up
+        self.conn = None
+        for _ in range(120):
+            try:
+                self.conn = Client(self.address, authkey=worker_authkey)
+                break
+            except OSError:
+                if self.proc.poll() is not None:
+                    break
+                time.sleep(0.5)
+
+        # check the connection reached the process just started: a worker.py left
+        # over from an earlier run would still hold the port, and would run jobs with
+        # stale code while preempt, close and restart kill the new process
+        pids = ()
+        try:
+            if self.conn is not None and self.conn.poll(10):
+                pids = self.conn.recv()
+        except (EOFError, OSError):
+            pass
+        if self.proc.pid not in pids:
+            if self.conn is not None:
+                self.conn.close()
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.wait()
+            raise RuntimeError(
+                f"Could not connect to the worker started at {self.address}, check "
+                "that no worker.py from an earlier run is still running"
+            )
+
+    def restart(self):
+        """Returns False if no fresh worker could be brought up."""
+        print("Restarting worker")
+        if self.conn is not None:
+            self.conn.close()
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        delay = 5
+        attempts = 3
+        for attempt in range(1, attempts + 1):
+            try:
+                self.start()
+                return True
+            except (RuntimeError, OSError) as e:
+                print(f"Restart attempt {attempt}/{attempts} failed: {e}")
+                if attempt < attempts:
+                    stop_event.wait(delay)
+                    delay *= 2
+        return False
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.wait()
+
+    def preempt(self, dir_to_process):
+        """Kills the job processing dir_to_process, for which run() then returns
+        None. Returns False, doing nothing, if that job isn't running right now."""
+        with self.lock:
+            if self.current_job != dir_to_process or self.preempted_job is not None:
+                return False
+            self.preempted_job = dir_to_process
+            self.proc.terminate()
+            return True
+
+    def run(self, dir_to_process, log_file):
+        """Blocks until the worker has finished processing dir_to_process, and
+        returns its exit status, or None if the job was preempted or the watcher is
+        stopping."""
+        with self.lock:
+            # checked under the lock, so a stop either lands here or finds the job
+            # running and preempts it
+            if stop_event.is_set():
+                return None
+            self.current_job = dir_to_process
+
+        lost = None
+        try:
+            self.conn.send((dir_to_process, log_file))
+            exit_status = self.conn.recv()
+        except (EOFError, OSError) as e:
+            exit_status = None
+            lost = e
+
+        with self.lock:
+            self.current_job = None
+            preempted = self.preempted_job is not None
+            self.preempted_job = None
+
+        if lost is not None and not preempted:
+            # worker died mid-job, report a failure and bring up a fresh one
+            print(f"Lost connection to worker: {lost!r}")
+            exit_status = 1
+        # a preempt can also land just after the job finished: its result stands,
+        # but the process was killed all the same
+        if (lost is not None or preempted) and not stop_event.is_set():
+            if not self.restart():
+                # the job's status still stands, but nothing more can be run
+                print("Could not restart the worker, stopping the queue watcher")
+                self.broken = True
+                stop_event.set()
+        return exit_status
+
+
+def open_state_db():
+    """Holds the queued folders and when each user directory was last listed, see
+    update_queue_state. Kept in memory: anything could have been queued, renamed or
+    removed while the watcher was down, so every start rescans from scratch anyway."""
+    conn = sqlite3.connect(":memory:")
+    conn.executescript("""
+        CREATE TABLE jobs(
+            path TEXT PRIMARY KEY, user_dir TEXT, rank INT, leaf TEXT
+        );
+        CREATE INDEX idx_jobs_order ON jobs(rank, leaf);
+        CREATE TABLE user_dirs(path TEXT PRIMARY KEY, mtime_ns INT);
+        """)
+    return conn
+
+
+def update_queue_state(state):
+    """Brings the jobs table in line with the queued folders on disk. A directory's
+    mtime changes whenever an entry in it is created, renamed or removed, so only
+    user directories whose mtime moved since they were last listed are relisted."""
+    seen = set()
+    with os.scandir(root_directory) as it:
+        user_dirs = [
+            e for e in it if e.name != "System Volume Information" and e.is_dir()
+        ]
+    for user_dir in user_dirs:
+        # taken before listing, so a change made during the listing is caught next
+        # time. os.stat because on windows DirEntry.stat comes from the root's listing
+        # rather than the directory itself
+        try:
+            mtime_ns = os.stat(user_dir.path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        seen.add(user_dir.path)
+        row = state.execute(
+            "SELECT mtime_ns FROM user_dirs WHERE path = ?", (user_dir.path,)
+        ).fetchone()
+        if row is not None and row[0] == mtime_ns:
+            continue
+
+        try:
+            imaging_dirs = os.listdir(user_dir.path)
+        except FileNotFoundError:
+            seen.discard(user_dir.path)
+            continue
+        state.execute("DELETE FROM jobs WHERE user_dir = ?", (user_dir.path,))
+        for imaging_dir in imaging_dirs:
+            rank = get_priority_rank(imaging_dir)
+            if rank < len(queue_suffixes):
+                state.execute(
+                    "INSERT INTO jobs VALUES (?, ?, ?, ?)",
+                    (
+                        os.path.join(user_dir.path, imaging_dir),
+                        user_dir.path,
+                        rank,
+                        imaging_dir,
+                    ),
+                )
+        # the mtime only moves on a coarse clock tick, so a second change landing in
+        # the same tick as the listing would go unseen. as git does with racy
+        # timestamps, don't trust an mtime this recent and list again next time
+        if time.time_ns() - mtime_ns < racy_mtime_window:
+            mtime_ns = None
+        state.execute(
+            "INSERT OR REPLACE INTO user_dirs VALUES (?, ?)", (user_dir.path, mtime_ns)
+        )
+
+    for (path,) in state.execute("SELECT path FROM user_dirs").fetchall():
+        if path not in seen:
+            state.execute("DELETE FROM jobs WHERE user_dir = ?", (path,))
+            state.execute("DELETE FROM user_dirs WHERE path = ?", (path,))
+    state.commit()
+
+
+def get_queued_folder(state, exclude=()):
+    """Returns the next folder to process and its path with the queue suffix
+    stripped, or (None, None). Folders in exclude, ie already being processed, are
+    not considered."""
+    update_queue_state(state)
+    # highest priority first, then the earliest date directory
+    candidates = [
+        (path, rank)
+        for path, rank in state.execute(
+            "SELECT path, rank FROM jobs ORDER BY rank, leaf"
+        )
+        if path not in exclude
     ]
 
-    all_candidates = (
-        high_priority_dir_fullpaths + regular_dir_fullpaths + low_priority_dir_fullpaths
-    )
-    if len(all_candidates) > 0:
+    if len(candidates) > 0:
         print("Candidate imaging data directories:")
-        for cdfp in (
-            high_priority_dir_fullpaths
-            + regular_dir_fullpaths
-            + low_priority_dir_fullpaths
-        ):
+        for cdfp, _ in candidates:
             print(f"  {cdfp}")
 
-    if len(high_priority_dir_fullpaths) > 0:
-        # Get the earliest date directory among the high_priority_dir_fullpaths
-        leaf_dirs = [
-            os.path.basename(os.path.normpath(x)) for x in high_priority_dir_fullpaths
-        ]
-        sorted_indices = [
-            i for i, value in sorted(enumerate(leaf_dirs), key=lambda x: x[1])
-        ]
-        chosen_dir_fullpath = high_priority_dir_fullpaths[sorted_indices[0]]
-        stripped_fullpath = chosen_dir_fullpath[:-12]
-    elif len(regular_dir_fullpaths) > 0:
-        leaf_dirs = [
-            os.path.basename(os.path.normpath(x)) for x in regular_dir_fullpaths
-        ]
-        sorted_indices = [
-            i for i, value in sorted(enumerate(leaf_dirs), key=lambda x: x[1])
-        ]
-        chosen_dir_fullpath = regular_dir_fullpaths[sorted_indices[0]]
-        stripped_fullpath = chosen_dir_fullpath[:-9]
-    elif len(low_priority_dir_fullpaths) > 0:
-        leaf_dirs = [
-            os.path.basename(os.path.normpath(x)) for x in low_priority_dir_fullpaths
-        ]
-        sorted_indices = [
-            i for i, value in sorted(enumerate(leaf_dirs), key=lambda x: x[1])
-        ]
-        chosen_dir_fullpath = low_priority_dir_fullpaths[sorted_indices[0]]
-        stripped_fullpath = chosen_dir_fullpath[:-12]
-    else:
-        chosen_dir_fullpath = None
-        stripped_fullpath = None
-
-    if chosen_dir_fullpath is not None:
+    if len(candidates) > 0:
+        chosen_dir_fullpath, rank = candidates[0]
         print(f"Chosen: {chosen_dir_fullpath}")
+        return chosen_dir_fullpath, chosen_dir_fullpath[: -len(queue_suffixes[rank])]
 
-    return chosen_dir_fullpath, stripped_fullpath
+    return None, None
 
 
 def get_banned_dirs():
@@ -97,40 +356,52 @@ def get_banned_dirs():
 
 
 def attempt_rename(source, target):
-    print(f"Attemping rename {source} to {target}")
-    attempts = 3
-    while attempts > 0:
-        attempts -= 1
+    print(f"Attempting rename {source} to {target}")
+    # transient locks (AV scans, explorer windows) usually clear in well under a
+    # second, so back off exponentially rather than sleeping a full minute
+    delay = 0.5
+    attempts = 8
+    for attempt in range(1, attempts + 1):
         try:
-            os.rename(source, target)
+            # a leftover target from an earlier run would fail every attempt, so move
+            # it aside rather than clobbering what might be real output
+            if os.path.isdir(target):
+                stale = target + "_stale_" + strftime("%Y%m%d-%H%M%S")
+                print(f"{target} already exists, moving it to {stale}")
+                os.replace(target, stale)
+            os.replace(source, target)
             print(f"Rename successful {source} to {target}")
             return
-        except:
-            print(f"Rename attempt {attempts} failed")
-            time.sleep(60)
+        except OSError as e:
+            print(f"Rename attempt {attempt}/{attempts} failed: {e}")
+            if attempt < attempts:
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+    print(f"Giving up on rename {source} to {target}")
 
 
-def launch_main_processing(dir_to_process, stripped_folder, log_folder):
-    log_file = "dataflow_log_" + strftime("%Y%m%d-%H%M%S") + ".txt"
+def launch_main_processing(dir_to_process, stripped_folder, log_folder, worker):
+    # include the folder name so concurrent jobs started in the same second don't
+    # share a log
+    log_file = (
+        "dataflow_log_"
+        + strftime("%Y%m%d-%H%M%S")
+        + "_"
+        + os.path.basename(stripped_folder)
+        + ".txt"
+    )
     full_log_file = os.path.join(log_folder, log_file)
 
-    # the >> redirects stdout with appending. the 2>&1 does the same with stderr
-    # double quotes to accommodates spaces in directory name
-    # this command is blocking so this watcher will just wait here until main.py is finished
+    # the worker writes stdout and stderr of main.py to the log file itself
+    # this call is blocking so this watcher will just wait here until main.py is finished
     print(f"launching {dir_to_process}")
     print(f"log file {full_log_file}")
 
-    f = open(full_log_file, "w")
-    exit_status = subprocess.call(
-        [
-            "python",
-            "C:/Users/User/projects/brukerbridge/scripts/main.py",
-            dir_to_process,
-        ],
-        stdout=f,
-        stderr=f,
-    )
+    exit_status = worker.run(dir_to_process, full_log_file)
 
+    if exit_status is None:
+        print(f"Preempted, leaving {dir_to_process} in the queue")
+        return
     # stderr=subprocess.STDOUT
     if exit_status != 0:
         print(
@@ -15,16 +15,19 @@ def main(directory):
     os.system("C:/Users/User/projects/brukerbridge/scripts/ripper_killer.bat")
 
 def check_for_raw_files(directory, raws_exist):
-    for item in os.listdir(directory):
-        new_path = directory + '/' + item
+    # scandir already knows which entries are directories, so no stat per entry
+    with os.scandir(directory) as it:
+        entries = list(it)
+    for entry in entries:
+        new_path = directory + '/' + entry.name
 
         # Check if item is a directory
-        if os.path.isdir(new_path):
+        if entry.is_dir():
             raws_exist = check_for_raw_files(new_path, raws_exist)
             
         # If the item is a file
         else:
-            if '_RAWDATA_' in item:
+            if '_RAWDATA_' in entry.name:
                 raws_exist = True
     return raws_exist
 
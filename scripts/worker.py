@@ -0,0 +1,82 @@
+import os
+import signal
+import sys
+import traceback
+from multiprocessing.connection import Listener
+
+# imported once for the life of the worker so each job skips interpreter startup
+# and the heavy brukerbridge/nibabel/numpy imports
+import main as main_processing
+
+authkey = b"brukerbridge"
+
+
+def main(host, port):
+    # stdout is the worker log file, which python would otherwise block buffer
+    sys.stdout.reconfigure(line_buffering=True)
+    sys.stderr.reconfigure(line_buffering=True)
+    # ctrl-c in the console reaches the worker too, but the queue watcher decides
+    # what happens to the job in progress
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    address = (host, int(port))
+    with Listener(address, authkey=authkey) as listener:
+        print(f"Worker listening on {address}", flush=True)
+        while True:
+            with listener.accept() as conn:
+                # lets the watcher check it reached the worker it started, and not one
+                # left over from an earlier run. the parent is sent too, in case
+                # python was started through a launcher
+                conn.send((os.getpid(), os.getppid()))
+                serve(conn)
+
+
+def serve(conn):
+    while True:
+        try:
+            dir_to_process, log_file = conn.recv()
+        except EOFError:
+            # queue watcher went away, wait for it to reconnect
+            return
+        conn.send(run_job(dir_to_process, log_file))
+
+
+def run_job(dir_to_process, log_file):
+    """Run main.py on dir_to_process in this process, sending stdout and stderr to
+    log_file. Returns an exit status in the same sense as the old subprocess call."""
+    # line buffered, so the log can be tailed while the job runs
+    with open(log_file, "w", buffering=1, encoding="utf-8") as f:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # redirect at the fd level so the ripper and other children inherit the log
+        saved_stdout, saved_stderr = os.dup(1), os.dup(2)
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+        # and swap the python streams too: on a windows console they write to the
+        # console directly rather than through fd 1
+        saved_sys_stdout, saved_sys_stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = f
+        try:
+            main_processing.main([dir_to_process])
+            exit_status = 0
+        except SystemExit as e:
+            if e.code is None:
+                exit_status = 0
+            elif isinstance(e.code, int):
+                exit_status = e.code
+            else:
+                exit_status = 1
+        except Exception:
+            traceback.print_exc()
+            exit_status = 1
+        finally:
+            f.flush()
+            sys.stdout, sys.stderr = saved_sys_stdout, saved_sys_stderr
+            os.dup2(saved_stdout, 1)
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stdout)
+            os.close(saved_stderr)
+    return exit_status
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])